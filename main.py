@@ -1,13 +1,21 @@
 import argparse
+import glob
+import hashlib
+import json
 import random
-import time
 from pathlib import Path
 from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import threading
 import os
 
 os.environ["PYGAME_HIDE_SUPPORT_PROMPT"] = "1"
 import pygame
+
+try:
+    import faiss
+except ImportError:
+    faiss = None
 import numpy as np
 from tqdm import tqdm
 from rapidfuzz import process, fuzz
@@ -21,6 +29,17 @@ class MusicPlayer:
 
         self.initialize_embeddings()
 
+        # Playback order is a permutation over the (fixed) embedding rows:
+        # position p plays track self.order[p]. order_position is the
+        # inverse, mapping a track row back to its playlist position.
+        self.order = np.arange(len(self.playlist_paths))
+        self.order_position = np.arange(len(self.playlist_paths))
+
+        # Search helpers, computed once since the playlist never changes
+        self.song_stems = [p.stem for p in self.playlist_paths]
+        self.song_stems_lower = [s.lower() for s in self.song_stems]
+        self.name_to_index = {p.name: i for i, p in enumerate(self.playlist_paths)}
+
         self.current_embedding = None
         self.current_track_index = 0
         self.next_tracks_indices = []
@@ -30,6 +49,8 @@ class MusicPlayer:
         self.recently_played = deque(
             maxlen=len(self.playlist_paths) - 1
         )  # used to prevent duplicates for next nearest neighbors
+        # Boolean mirror of recently_played for O(1)/vectorized lookups
+        self.recent_mask = np.zeros(len(self.playlist_paths), dtype=bool)
         self.should_exit = False
         pygame.mixer.init()
         pygame.mixer.music.set_volume(self.current_volume)
@@ -48,57 +69,228 @@ class MusicPlayer:
         except ValueError:
             print("Invalid input. Please enter a number between 0.0 and 1.0")
 
+    def store_key(self, file):
+        """Cache key from (name, size, mtime) - no file contents are read"""
+        st = file.stat()
+        return f"{file.name}_{st.st_size}_{st.st_mtime_ns}"
+
+    def cache_path(self, file):
+        cache_file = self.cache_directory / f"{self.store_key(file)}.npy"
+        if not cache_file.exists():
+            st = file.stat()
+            # Migrate caches written under older schemas: name_size .npz
+            # containers and name_size_mtime .npy files with a stale mtime.
+            # Matched exactly so a size that happens to prefix another
+            # (1234 vs 12345) cannot grab the wrong file.
+            size_key = f"{glob.escape(file.name)}_{st.st_size}"
+            legacy_files = [
+                legacy_file
+                for pattern in (f"{size_key}.npz", f"{size_key}_*.npy")
+                for legacy_file in self.cache_directory.glob(pattern)
+                if not legacy_file.stem.endswith("_spec")
+            ]
+            for legacy_file in legacy_files:
+                if legacy_file.suffix == ".npz":
+                    with np.load(legacy_file) as data:
+                        np.save(cache_file, data["embedding"])
+                    legacy_file.unlink()
+                else:
+                    legacy_file.rename(cache_file)
+                break
+        return cache_file
+
     def initialize_embeddings(self):
         self.cache_directory.mkdir(parents=True, exist_ok=True)
+        self.store_file = self.cache_directory / "embeddings.npy"
+        self.manifest_file = self.cache_directory / "embeddings.json"
         self.playlist_paths = []
-        self.music_embeddings = []
+        # Final (N, d) float32 buffer, allocated once the embedding dim is
+        # known; rows are written in place instead of stacking a list copy
+        self.music_embeddings = None
+        self._next_row = 0
 
         current_files = list(self.music_directory.rglob("*.mp3"))
         print("Initializing embeddings...")
 
+        # Step 0: memory-map the consolidated store if the library is unchanged
+        if self.store_file.exists() and self.manifest_file.exists():
+            with open(self.manifest_file) as f:
+                manifest = json.load(f)
+            current_keys = {str(file): self.store_key(file) for file in current_files}
+            if manifest.get("version") == self.STORE_VERSION and current_keys == dict(
+                zip(manifest["paths"], manifest["keys"])
+            ):
+                self.music_embeddings = np.load(self.store_file, mmap_mode="r")
+                self.playlist_paths = [Path(p) for p in manifest["paths"]]
+                self.build_index()
+                print(f"Loaded {len(self.playlist_paths)} songs from store.")
+                return
+
         # Step 1: Load existing files from cache
         cached_files = []
         new_files = []
         for file in current_files:
-            file_name = file.name
-            file_size = os.path.getsize(file)
-            cache_file = self.cache_directory / f"{file_name}_{file_size}.npz"
+            cache_file = self.cache_path(file)
             if cache_file.exists():
                 cached_files.append((file, cache_file))
             else:
                 new_files.append(file)
 
         print(f"Loading {len(cached_files)} cached files...")
-        for file, cache_file in tqdm(
-            cached_files, desc="Loading cached files", unit="file"
-        ):
-            with np.load(cache_file) as data:
-                embedding = data["embedding"]
-            self.playlist_paths.append(file)
-            self.music_embeddings.append(embedding)
+
+        def load_cached(entry):
+            file, cache_file = entry
+            # Eager read (no mmap): the embedding bytes must be paged in
+            # here, in the worker, or the I/O happens serially later when
+            # the row is copied into the matrix
+            return file, np.load(cache_file)
+
+        # np.load releases the GIL while reading, so threads overlap disk I/O.
+        # executor.map keeps the playlist in deterministic order.
+        with ThreadPoolExecutor(max_workers=min(32, os.cpu_count() * 4)) as executor:
+            for file, embedding in tqdm(
+                executor.map(load_cached, cached_files),
+                total=len(cached_files),
+                desc="Loading cached files",
+                unit="file",
+            ):
+                self.playlist_paths.append(file)
+                self.append_embedding(embedding, len(current_files))
 
         # Step 2: Embed and cache new files
         print(f"Processing {len(new_files)} new files...")
         if len(new_files) > 0:
             # Only load embedding model if new files exist
-            from music_embedder import audio_embed
+            from music_embedder import audio_embed_batch
             # from music_embedder_mert import audio_embed
 
-            for file in tqdm(new_files, desc="Processing new files", unit="file"):
-                file_name = file.name
-                file_size = os.path.getsize(file)
-                cache_file = self.cache_directory / f"{file_name}_{file_size}.npz"
-
-                embedding = audio_embed(str(file))
-                np.savez_compressed(
-                    cache_file, embedding=embedding, file_path=str(file)
+            # Micro-batches keep the model's matmuls busy without padding
+            # wildly different clip lengths against each other; sorting by
+            # file size (a duration proxy) groups similar lengths per batch
+            new_files.sort(key=lambda file: file.stat().st_size)
+            batch_size = 8
+            for start in tqdm(
+                range(0, len(new_files), batch_size),
+                desc="Processing new files",
+                unit="batch",
+            ):
+                batch = new_files[start : start + batch_size]
+                embeddings, specs = audio_embed_batch(
+                    [str(file) for file in batch], return_specs=True
                 )
+                for file, embedding, spec in zip(batch, embeddings, specs):
+                    cache_file = self.cache_path(file)
+                    # float16 halves cache size; neighbor ranking does not
+                    # need the extra precision. Cast back at stack time.
+                    # Uncompressed .npy: deflate saves almost nothing on
+                    # dense float vectors but costs CPU on every load.
+                    np.save(cache_file, embedding.astype(np.float16))
+                    # Keep the mel spectrogram so a model swap can re-embed
+                    # without re-decoding the audio (audio_embed_from_spec)
+                    spec_file = cache_file.with_name(f"{cache_file.stem}_spec.npy")
+                    np.save(spec_file, spec.astype(np.float16))
+                    self.playlist_paths.append(file)
+                    self.append_embedding(embedding, len(current_files))
+
+        if self.music_embeddings is None:
+            self.music_embeddings = np.empty((0, 0), dtype=np.float32)
+        # L2-normalize once so Euclidean ranking becomes maximum inner
+        # product; the store keeps normalized rows (see STORE_VERSION)
+        norms = np.linalg.norm(self.music_embeddings, axis=1, keepdims=True)
+        np.divide(
+            self.music_embeddings, np.maximum(norms, 1e-12), out=self.music_embeddings
+        )
+        self.save_store()
+        self.build_index()
+        print(f"Found and processed {len(self.playlist_paths)} songs.")
 
-                self.playlist_paths.append(file)
-                self.music_embeddings.append(embedding)
+    def append_embedding(self, embedding, n_files):
+        """Write one embedding into the preallocated (N, d) float32 matrix"""
+        if self.music_embeddings is None:
+            self.music_embeddings = np.empty(
+                (n_files, embedding.shape[-1]), dtype=np.float32
+            )
+        self.music_embeddings[self._next_row] = embedding
+        self._next_row += 1
+
+    def save_store(self):
+        """Atomically rewrite the consolidated store so the next startup
+        is a single mmap instead of thousands of per-file cache reads."""
+        tmp = self.store_file.with_suffix(".npy.tmp")
+        with open(tmp, "wb") as f:
+            np.save(f, self.music_embeddings)
+        os.replace(tmp, self.store_file)
+
+        manifest = {
+            "version": self.STORE_VERSION,
+            "paths": [str(p) for p in self.playlist_paths],
+            "keys": [self.store_key(p) for p in self.playlist_paths],
+        }
+        tmp = self.manifest_file.with_suffix(".json.tmp")
+        tmp.write_text(json.dumps(manifest))
+        os.replace(tmp, self.manifest_file)
+
+    # Small libraries are fast enough with an exact flat index
+    HNSW_MIN_TRACKS = 2000
+    # Bumped whenever the consolidated store format changes
+    # (v2: rows are L2-normalized)
+    STORE_VERSION = 2
+
+    def build_index(self):
+        """Build a FAISS index over the embedding matrix for fast NN search
+
+        Rows are unit vectors, so maximum inner product gives the same
+        ranking as Euclidean distance and is cheaper to serve. Small
+        libraries get an exact flat index; large ones an approximate HNSW
+        graph (cached on disk), where exact ranking is not worth the
+        linear scan.
+        """
+        n, d = self.music_embeddings.shape
+        if faiss is None:
+            self.index = None
+            return
+        if n < self.HNSW_MIN_TRACKS:
+            self.index = faiss.IndexFlatIP(d)
+            self.index.add(self.music_embeddings)
+            return
+
+        # Key the cached graph by the indexed files' (name, size, mtime)
+        # cache keys - not their order, and not bare paths, so editing a
+        # file in place invalidates the graph along with its embedding
+        library_key = hashlib.md5(
+            "\n".join(sorted(self.store_key(p) for p in self.playlist_paths)).encode()
+        ).hexdigest()
+        index_file = self.cache_directory / f"index_{library_key}.ip.hnsw"
+        if index_file.exists():
+            self.index = faiss.read_index(str(index_file))
+            return
+
+        self.index = faiss.IndexHNSWFlat(d, 32, faiss.METRIC_INNER_PRODUCT)
+        self.index.hnsw.efConstruction = 64
+        self.index.add(self.music_embeddings)
+        faiss.write_index(self.index, str(index_file))
+
+    def remember_played(self, track):
+        """Record a played embedding row in the deque and its mask mirror"""
+        if self.recently_played.maxlen == 0:
+            # Single-track library: a maxlen=0 deque drops appends, so
+            # setting the mask bit would desync it from the (empty) deque
+            return
+        if self.recent_mask[track]:
+            # Replays move to the back instead of occupying two slots, so
+            # an eviction can never clear the bit of a still-queued row
+            self.recently_played.remove(track)
+        elif (
+            self.recently_played
+            and len(self.recently_played) == self.recently_played.maxlen
+        ):
+            self.recent_mask[self.recently_played[0]] = False
+        self.recently_played.append(track)
+        self.recent_mask[track] = True
 
-        self.music_embeddings = np.array(self.music_embeddings)
-        print(f"Found and processed {len(self.playlist_paths)} songs.")
+    def clear_recently_played(self):
+        self.recently_played.clear()
+        self.recent_mask.fill(False)
 
     def toggle_play_pause(self):
         if not self.is_playing:
@@ -115,12 +307,13 @@ class MusicPlayer:
 
     def play_current_track(self):
         self.is_playing = True
-        self.current_embedding = self.music_embeddings[self.current_track_index]
-        pygame.mixer.music.load(self.playlist_paths[self.current_track_index])
+        track = self.order[self.current_track_index]
+        self.current_embedding = self.music_embeddings[track]
+        pygame.mixer.music.load(self.playlist_paths[track])
         pygame.mixer.music.play()
         self.history.append(self.current_track_index)
-        self.recently_played.append(self.current_track_index)
-        print(f"Playing: {Path(self.playlist_paths[self.current_track_index]).name}")
+        self.remember_played(int(track))
+        print(f"Playing: {Path(self.playlist_paths[track]).name}")
 
     def like_song(self):
         """Sample new neighbors based on current song"""
@@ -136,55 +329,100 @@ class MusicPlayer:
                 # Fetch new similar tracks based on current track
                 self.next_tracks_indices = self.find_nearest_embeddings()
 
-            # Skip duplicate songs
-            dist = np.linalg.norm(
-                self.music_embeddings[self.current_track_index]
-                - self.music_embeddings[self.next_tracks_indices[0]]
-            )
-            # Magic number to skip (nearly exact) duplicates
-            if dist < 0.26:
-                print(
-                    "skipping duplicate:",
-                    self.playlist_paths[self.next_tracks_indices[0]].name,
-                    dist,
+            if len(self.next_tracks_indices) > 0:
+                # Skip duplicate songs
+                dist = np.linalg.norm(
+                    self.current_embedding
+                    - self.music_embeddings[self.next_tracks_indices[0]]
                 )
-                self.recently_played.append(self.next_tracks_indices[0])
-                self.next_tracks_indices = self.next_tracks_indices[1:]
+                # Magic number to skip (nearly exact) duplicates. On unit
+                # vectors d = sqrt(2 - 2*cos), so 0.1 means cosine >= 0.995 -
+                # the same re-encodes/re-masters the old 0.26 caught at
+                # typical pre-normalization norms of ~2.6
+                if dist < 0.1:
+                    print(
+                        "skipping duplicate:",
+                        self.playlist_paths[self.next_tracks_indices[0]].name,
+                        dist,
+                    )
+                    self.remember_played(self.next_tracks_indices[0])
+                    self.next_tracks_indices = self.next_tracks_indices[1:]
 
-            # Select next track
-            self.current_track_index = self.next_tracks_indices[0]
+            if len(self.next_tracks_indices) == 0:
+                # The search filters recently played rows (and HNSW is
+                # approximate), so it can come back empty or get exhausted
+                # by the duplicate skip; fall back to a random track
+                print("No unplayed neighbors found, picking a random track")
+                self.next_track(similar=False)
+                return
+
+            # Select next track (neighbors are embedding rows)
+            track = self.next_tracks_indices[0]
             self.next_tracks_indices = self.next_tracks_indices[1:]
-            self.current_embedding = self.music_embeddings[self.current_track_index]
+            self.current_track_index = int(self.order_position[track])
+            self.current_embedding = self.music_embeddings[track]
         else:
             self.current_track_index = random.randint(0, len(self.playlist_paths) - 1)
-            self.current_embedding = self.music_embeddings[self.current_track_index]
+            self.current_embedding = self.music_embeddings[
+                self.order[self.current_track_index]
+            ]
             # Reset recently played and next tracks on random shuffle
-            self.recently_played.clear()
+            self.clear_recently_played()
             self.next_tracks_indices = []
 
         if self.is_playing:
             self.play_current_track()
         else:
             print(
-                f"Next track selected: {self.playlist_paths[self.current_track_index].name}"
+                f"Next track selected: {self.playlist_paths[self.order[self.current_track_index]].name}"
             )
 
     def find_nearest_embeddings(self, k=17):
-        distances = np.linalg.norm(
-            self.music_embeddings - self.current_embedding, axis=1
-        )
+        if self.index is None:
+            return self.find_nearest_brute(k)
+        # current_embedding is a row of the normalized matrix, so it is
+        # already a unit vector
+        query = self.current_embedding.reshape(1, -1).astype(np.float32)
+        if isinstance(self.index, faiss.IndexHNSWFlat):
+            self.index.hnsw.efSearch = max(64, k * 4)
+        # Fetch extra neighbors so we can drop recently played ones
+        similarities, indices = self.index.search(query, k + len(self.recently_played))
 
         # Prevent looping of similar songs
-        for idx in self.recently_played:
-            distances[idx] = np.inf
+        nearest_neighbors = []
+        distances = []
+        for idx, sim in zip(indices[0], similarities[0]):
+            if idx < 0 or self.recent_mask[idx]:
+                continue
+            nearest_neighbors.append(int(idx))
+            # On unit vectors: |x - q|^2 = 2 - 2 x.q
+            distances.append(np.sqrt(max(2.0 - 2.0 * sim, 0.0)))
+            if len(nearest_neighbors) == k:
+                break
 
-        # Get indices of k nearest neighbors
-        nearest_neighbors = np.argsort(distances)[:k]
         print("new neighbors:")
-        for i in nearest_neighbors:
-            print(self.playlist_paths[i].name, distances[i])
+        for i, dist in zip(nearest_neighbors, distances):
+            print(self.playlist_paths[i].name, dist)
         return nearest_neighbors
 
+    def find_nearest_brute(self, k):
+        """Exact NN search without FAISS: one GEMV of inner products"""
+        sims = self.music_embeddings.dot(self.current_embedding.astype(np.float32))
+
+        # Prevent looping of similar songs
+        sims[self.recent_mask] = -np.inf
+
+        # O(N) partition for the k most similar, then sort just those k
+        if k < sims.size:
+            nearest_neighbors = np.argpartition(-sims, k)[:k]
+        else:
+            nearest_neighbors = np.arange(sims.size)
+        nearest_neighbors = nearest_neighbors[np.argsort(-sims[nearest_neighbors])]
+        print("new neighbors:")
+        for i in nearest_neighbors:
+            print(self.playlist_paths[i].name, np.sqrt(max(2.0 - 2.0 * sims[i], 0.0)))
+        return list(nearest_neighbors)
+
     def previous_track(self):
         if len(self.history) > 1:
             self.history.pop()
@@ -198,53 +436,63 @@ class MusicPlayer:
             self.play_current_track()
         else:
             print(
-                f"Previous track selected: {self.playlist_paths[self.current_track_index].name}"
+                f"Previous track selected: {self.playlist_paths[self.order[self.current_track_index]].name}"
             )
 
     def shuffle_playlist(self):
-        combined = list(zip(self.playlist_paths, self.music_embeddings))
-        random.shuffle(combined)
-        self.playlist_paths, self.music_embeddings = zip(*combined)
-        self.playlist_paths = list(self.playlist_paths)
-        self.music_embeddings = np.array(self.music_embeddings)
-        self.recently_played.clear()
+        # Shuffling only permutes the playback order; the embedding matrix
+        # and the FAISS index never move, so nothing is copied or rebuilt
+        np.random.shuffle(self.order)
+        self.order_position[self.order] = np.arange(len(self.order))
+        self.clear_recently_played()
         print("Playlist shuffled.")
 
-    @staticmethod
-    def custom_scorer(query, choice, score_cutoff=0):
-        if query.lower() in choice.lower():
-            return 100  # Exact substring match
-        else:
-            return fuzz.WRatio(query, choice)  # Fuzzy match
-
     def fuzzy_search(self, query):
-        song_names = [p.stem for p in self.playlist_paths]
-        results = process.extract(
-            query, song_names, scorer=self.custom_scorer, limit=10
-        )
-        results = [(r, s) for r, s, _i in results]
+        query_lower = query.lower()
+
+        # Substring hits count as exact matches
+        results = [
+            (self.song_stems[i], 100.0)
+            for i, stem in enumerate(self.song_stems_lower)
+            if query_lower in stem
+        ][:10]
+
+        if len(results) < 10:
+            # Fuzzy-match the remainder entirely in rapidfuzz's C scorer
+            # instead of re-entering Python once per candidate
+            remainder = [
+                self.song_stems[i]
+                for i, stem in enumerate(self.song_stems_lower)
+                if query_lower not in stem
+            ]
+            fuzzy_results = process.extract(
+                query,
+                remainder,
+                scorer=fuzz.WRatio,
+                processor=str.lower,
+                limit=10 - len(results),
+            )
+            results += [(r, s) for r, s, _i in fuzzy_results]
         return results
 
     def play_song_by_index(self, index):
         if 0 <= index < len(self.playlist_paths):
-            self.current_track_index = index
+            # index is an embedding row; map it to its playlist position
+            self.current_track_index = int(self.order_position[index])
             self.next_tracks_indices = []  # Reset next tracks
-            self.recently_played.clear()  # Reset previous tracks queue
+            self.clear_recently_played()  # Reset previous tracks queue
             self.play_current_track()
         else:
             print("Invalid song index.")
 
-    def check_music_end(self):
-        """Auto-play next song"""
-        for event in pygame.event.get():
-            if event.type == pygame.USEREVENT:
-                self.next_track(similar=True)
-
     def run(self):
         while not self.should_exit:
-            if self.is_playing:
-                self.check_music_end()
-            time.sleep(0.1)
+            # Sleep in the kernel until pygame posts an event; the timeout
+            # only bounds how long an exit request can go unnoticed
+            event = pygame.event.wait(500)
+            if event.type == pygame.USEREVENT and self.is_playing:
+                # Track finished: auto-play next song
+                self.next_track(similar=True)
 
 
 def print_menu():
@@ -283,9 +531,7 @@ def handle_user_input(player):
                 "Enter the number of the song you want to play (or press Enter to cancel): "
             )
             if choice.isdigit() and 1 <= int(choice) <= 10:
-                index = [p.name for p in player.playlist_paths].index(
-                    f"{results[int(choice)-1][0]}.mp3"
-                )
+                index = player.name_to_index[f"{results[int(choice)-1][0]}.mp3"]
                 player.play_song_by_index(index)
         elif command == "c":
             print("Current volume:", player.current_volume)
@@ -1,7 +1,8 @@
 import torch
 import librosa
+import soundfile as sf
+import soxr
 from torch import autocast
-from contextlib import nullcontext
 
 from models.dymn.model import get_model as get_dymn
 from models.mn.model import get_model as get_mobilenet
@@ -10,54 +11,149 @@ from helpers.utils import NAME_TO_WIDTH
 
 
 model_name = "dymn10_as"
-print("Model:", model_name)
 strides = [2, 2, 2, 2]
 n_mels = 128
 sample_rate = 32000
 window_size = 800
 hop_size = 320
 
-# load pre-trained model
-if model_name.startswith("dymn"):
-    model = get_dymn(
-        width_mult=NAME_TO_WIDTH(model_name),
-        pretrained_name=model_name,
-        strides=strides,
-    )
-else:
-    model = get_mobilenet(
-        width_mult=NAME_TO_WIDTH(model_name),
-        pretrained_name=model_name,
-        strides=strides,
-    )
-
 device = torch.device("cuda") if torch.cuda.is_available() else torch.device("cpu")
 
-model.to(device)
-model.eval()
-# model to preprocess waveform into mel spectrograms
-mel = AugmentMelSTFT(
-    n_mels=n_mels, sr=sample_rate, win_length=window_size, hopsize=hop_size
-)
-mel.to(device)
-mel.eval()
+# Model and mel frontend are built lazily on first use so importing this
+# module stays cheap when every file is already cached
+model = None
+mel = None
+# Compiled conv stack without the classifier's whole-map average pooling;
+# the batch path pools per clip so padded frames are excluded
+feature_forward = None
+
+
+def get_embedder():
+    global model, mel, feature_forward
+    if model is None:
+        print("Model:", model_name)
+        # load pre-trained model
+        if model_name.startswith("dymn"):
+            model = get_dymn(
+                width_mult=NAME_TO_WIDTH(model_name),
+                pretrained_name=model_name,
+                strides=strides,
+            )
+        else:
+            model = get_mobilenet(
+                width_mult=NAME_TO_WIDTH(model_name),
+                pretrained_name=model_name,
+                strides=strides,
+            )
+        model.to(device)
+        model.eval()
+        # channels_last keeps the depthwise convs in their fast layout and
+        # torch.compile fuses the conv/activation chains
+        model = model.to(memory_format=torch.channels_last)
+        # DyMN exposes its conv stack as _feature_forward; MN keeps it in
+        # a plain Sequential. Either way the callable yields the
+        # (B, C, F, T') map the batch path pools per clip.
+        if hasattr(model, "_feature_forward"):
+            feature_forward = torch.compile(model._feature_forward)
+        else:
+            feature_forward = torch.compile(model.features)
+        model = torch.compile(model)
+        # model to preprocess waveform into mel spectrograms
+        mel = AugmentMelSTFT(
+            n_mels=n_mels, sr=sample_rate, win_length=window_size, hopsize=hop_size
+        )
+        mel.to(device)
+        mel.eval()
+    return model, mel
+
+
+def load_audio(audio_path):
+    """
+    Decode an audio file to mono float32 at the model sample rate.
+    soundfile + soxr decode and resample in native SIMD code; librosa
+    stays as a fallback for formats libsndfile cannot read.
+    """
+    try:
+        waveform, sr = sf.read(audio_path, dtype="float32", always_2d=False)
+    except Exception:
+        waveform, _ = librosa.core.load(audio_path, sr=sample_rate, mono=True)
+        return waveform
+    if waveform.ndim > 1:
+        waveform = waveform.mean(axis=1, dtype="float32")
+    if sr != sample_rate:
+        waveform = soxr.resample(waveform, sr, sample_rate, quality="HQ")
+    return waveform
+
+
+def _to_device(tensor):
+    if device.type == "cuda":
+        # Pinned staging lets the H2D copy run async
+        return tensor.pin_memory().to(device, non_blocking=True)
+    return tensor.to(device)
+
+
+# our models are trained in half precision mode (torch.float16)
+# cuda runs autocast float16; cpu runs autocast bfloat16, which halves
+# bytes moved per GEMM and hits AVX512-BF16/AMX kernels where available
+autocast_dtype = torch.bfloat16 if device.type == "cpu" else torch.float16
 
 
 def audio_embed(audio_path, head_type="mlp"):
     """
     Running Inference on an audio clip.
     """
+    return audio_embed_batch([audio_path])[0]
+
+
+def audio_embed_batch(audio_paths, return_specs=False):
+    """
+    Running Inference on a batch of audio clips in a single forward pass.
+    Mel spectrograms are computed per clip (so callers can persist them
+    unpadded for later re-embedding) and padded only for the model forward.
+    Each clip is pooled over its own valid frames, so the embedding does
+    not depend on which (longer) files shared the batch.
+    With return_specs=True also returns the list of unpadded spectrograms.
+    """
 
-    (waveform, _) = librosa.core.load(audio_path, sr=sample_rate, mono=True)
-    waveform = torch.from_numpy(waveform[None, :]).to(device)
+    _model, mel = get_embedder()
+    waveforms = [torch.from_numpy(load_audio(path)) for path in audio_paths]
 
-    # our models are trained in half precision mode (torch.float16)
-    # run on cuda with torch.float16 to get the best performance
-    # running on cpu with torch.float32 gives similar performance, using torch.bfloat16 is worse
-    with torch.no_grad(), autocast(
-        device_type=device.type
-    ) if device.type == "cuda" else nullcontext():
-        spec = mel(waveform)
-        _preds, features = model(spec.unsqueeze(0))
+    # inference_mode skips autograd's view/version tracking entirely
+    with torch.inference_mode():
+        specs = [mel(_to_device(waveform[None])).squeeze(0) for waveform in waveforms]
+        # Pad along time and stack to (B, n_mels, frames)
+        batch = torch.nn.utils.rnn.pad_sequence(
+            [spec.transpose(0, 1) for spec in specs], batch_first=True
+        ).transpose(1, 2)
+        with autocast(device_type=device.type, dtype=autocast_dtype):
+            feature_maps = feature_forward(batch.unsqueeze(1))
 
-    return features.squeeze(0).detach().numpy()
+        # Equivalent of the model's adaptive_avg_pool2d embedding, but per
+        # clip and restricted to the frames that came from real audio -
+        # averaging over padding would skew short clips in mixed batches
+        frames_per_step = batch.shape[-1] / feature_maps.shape[-1]
+        features = torch.stack(
+            [
+                feature_maps[i, :, :, : max(1, round(spec.shape[-1] / frames_per_step))]
+                .float()
+                .mean(dim=(1, 2))
+                for i, spec in enumerate(specs)
+            ]
+        )
+
+    embeddings = features.cpu().numpy()
+    if return_specs:
+        return embeddings, [spec.cpu().numpy() for spec in specs]
+    return embeddings
+
+
+def audio_embed_from_spec(spec):
+    """
+    Embed a precomputed mel spectrogram, skipping decode + mel. Lets a
+    model swap re-embed the library from cached spectrograms.
+    """
+    model, _mel = get_embedder()
+    spec = torch.as_tensor(spec, dtype=torch.float32, device=device)
+    with torch.inference_mode(), autocast(device_type=device.type, dtype=autocast_dtype):
+        _preds, features = model(spec.unsqueeze(0).unsqueeze(0))
+    return features.float().squeeze(0).cpu().numpy()